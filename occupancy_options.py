@@ -1,12 +1,14 @@
 from math import floor, sqrt
 
 # Master dictionary defining the region of interest for all VELO sensors.
-populated_regions = {}
-for mod in range(52):
-    populated_regions[f"Mod{mod}Sens0"] = {'x': [550, 750], 'y': [200, 250]}
-    populated_regions[f"Mod{mod}Sens1"] = {'x': [0, 250], 'y': [150, 250]}
-    populated_regions[f"Mod{mod}Sens2"] = {'x': [0, 200], 'y': [200, 250]}
-    populated_regions[f"Mod{mod}Sens3"] = {'x': [500, 750], 'y': [180, 250]}
+# The region only depends on the sensor index, so all 52 modules share
+# one frozen template per sensor rather than 208 freshly built dicts.
+sensor_regions = ({'x': (550, 750), 'y': (200, 250)},
+                  {'x': (0, 250),   'y': (150, 250)},
+                  {'x': (0, 200),   'y': (200, 250)},
+                  {'x': (500, 750), 'y': (180, 250)})
+populated_regions = {f"Mod{mod}Sens{sens}": sensor_regions[sens]
+                     for mod in range(52) for sens in range(4)}
 
 # The options function called by the main script.
 def options():
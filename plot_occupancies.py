@@ -1,13 +1,20 @@
-import ROOT
-from ROOT import TH1F, TCanvas, TFile
 import os,sys
 from math import floor, sqrt
-import subprocess
+import numpy as np
+import uproot
+import matplotlib
+matplotlib.use('Agg')  # headless backend, we only save files
+import matplotlib.pyplot as plt
 import json
-import time
+import calendar
+import pickle
+import atexit
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from importlib import import_module as load_options
 from pathlib import Path
 from save_in_dqdb import save_in_dqdb
+from velo_kernels import region_sum_1d, region_sum, hotspot_stats
 
 def run_dir_from_run_no(run_no):
     """
@@ -21,42 +28,215 @@ def run_dir_from_run_no(run_no):
     sd_2 = floor(run_no/1000)*1000
     return str(sd_1)+"/"+str(sd_2)+"/"
 
+def fetch_url(session, url, destination):
+    """
+    Fetch a single URL, optionally saving the response to a file.
+    Some of our "downloads" (notably createrunsaveset) only matter
+    for their side effect on the server, in which case the
+    destination is None and the response is thrown away.
+    """
+    response = session.get(url)
+    response.raise_for_status()
+    if destination is not None:
+        open(destination,'wb').write(response.content)
+
+def fetch_urls(downloads):
+    """
+    Download a batch of (url, destination) pairs concurrently.
+    The downloads are I/O bound so fetching them one run at a time
+    means network latency dominates the wall time; a thread pool
+    sharing one keep-alive session overlaps the waits instead.
+    Failures are reported but not fatal, the main loop deals with
+    whatever is still missing in the same way as before.
+    """
+    if not downloads:
+        return
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=32) as executor:
+        futures = {executor.submit(fetch_url, session, url, destination): url
+                   for url, destination in downloads}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Download of",futures[future],"failed:",e)
+
+def hist_to_array(histogram):
+    """
+    Bin contents of an uproot histogram as a NumPy array, including the
+    under/overflow bins so that arr[x] (or arr[x,y]) lines up with the
+    1-based ROOT bin numbering on every axis.
+    """
+    return histogram.values(flow=True)
+
+def hist_mean_rms(histogram):
+    """
+    Mean and RMS of the x axis with their errors, computed analytically
+    from the bin contents and centres as weighted NumPy sums. This is
+    the binned statistic TH1::GetMean/GetRMS fall back to after
+    ResetStats, and unlike the stored moments it also works for merged
+    savesets whose statistics were never propagated. The errors use
+    the effective entries from the stored moments when those exist.
+    """
+    contents = histogram.values()
+    if contents.ndim == 2:
+        contents = contents.sum(axis=1)
+    total = float(contents.sum())
+    if total <= 0:
+        return 0., 0., 0., 0.
+    centers = histogram.axis(0).centers()
+    mean = float((contents*centers).sum())/total
+    rms  = sqrt(max(float((contents*(centers-mean)**2).sum())/total, 0.))
+    sum_w  = histogram.member("fTsumw")
+    sum_w2 = histogram.member("fTsumw2")
+    n_effective = sum_w*sum_w/sum_w2 if sum_w2 > 0 else total
+    return mean, rms/sqrt(n_effective), rms, rms/sqrt(2.*n_effective)
+
+def find_bin(edges, value):
+    """
+    NumPy replacement for TAxis::FindBin on a cached edge array,
+    skipping the PyROOT dispatch. Returns the 1-based bin number,
+    with 0 and len(edges)+1 for under/overflow like ROOT does.
+    """
+    return int(np.searchsorted(edges, value, side='right'))
+
 def entries_selection(histogram, selection_type):
     """
-    Helper function to deal with multi-dimensional histograms
+    Helper function to deal with multi-dimensional histograms.
+    The integrals run as compiled velo_kernels reductions over the bin
+    content array, which avoids the histogram copies ProjectionX/Y
+    would make just to locate bin zero.
     """
-    is2D = histogram.InheritsFrom("TH2")
+    contents = hist_to_array(histogram)
+    is2D = contents.ndim == 2
     if selection_type in ["quadrant1", "quadrant2", "quadrant3", "quadrant4"] and not is2D:
-        print("entries_selection():",histogram.GetName(),"is not 2D histogram, choose a different method")
+        print("entries_selection():",histogram.name,"is not 2D histogram, choose a different method")
         sys.exit(0)
-    zero_x = histogram.FindBin(0)
-    zero_y = zero_x
+    nbins_x = contents.shape[0]-2
+    zero_x = find_bin(histogram.axis(0).edges(), 0)
     if is2D:
-        zero_x = histogram.ProjectionX().FindBin(0)
-        zero_y = histogram.ProjectionY().FindBin(0)
+        nbins_y = contents.shape[1]-2
+        zero_y = find_bin(histogram.axis(1).edges(), 0)
     match selection_type:
         case "negative":
             if is2D:
-                return histogram.Integral(1,zero_x,1,histogram.GetNbinsY())
+                return region_sum(contents, 1, zero_x, 1, nbins_y)
             else:
-                return histogram.Integral(1,zero_x)
+                return region_sum_1d(contents, 1, zero_x)
         case "positive":
             if is2D:
-                return histogram.Integral(zero_x,histogram.GetNbinsX(),1,histogram.GetNbinsY())
+                return region_sum(contents, zero_x, nbins_x, 1, nbins_y)
             else:
-                return histogram.Integral(zero_x,histogram.GetNbinsX())
+                return region_sum_1d(contents, zero_x, nbins_x)
         case "quadrant1":
-            return histogram.Integral(zero_x,histogram.GetNbinsX(),zero_y,histogram.GetNbinsY())
+            return region_sum(contents, zero_x, nbins_x, zero_y, nbins_y)
         case "quadrant2":
-            return histogram.Integral(1,zero_x,zero_y,histogram.GetNbinsY())
+            return region_sum(contents, 1, zero_x, zero_y, nbins_y)
         case "quadrant3":
-            return histogram.Integral(1,zero_x,1,zero_y)
+            return region_sum(contents, 1, zero_x, 1, zero_y)
         case "quadrant4":
-            return histogram.Integral(zero_x,histogram.GetNbinsX(),1,zero_y)
+            return region_sum(contents, zero_x, nbins_x, 1, zero_y)
         case _:
             print("entries_selection(): selection type",selection_type,"unknown")
             sys.exit(0)
 
+"""
+Each supported method becomes a callable taking (run_object, inv_hours)
+and returning (count, error), resolved from the options once at load
+time via resolve_method below. The hot loop then just calls through
+the table instead of re-matching the method string for every location
+of every run.
+"""
+
+def method_raw(run_object, inv_hours):
+    raw_count = run_object.member("fEntries")
+    return raw_count*inv_hours, sqrt(raw_count)*inv_hours
+
+def method_mean(run_object, inv_hours):
+    mean, mean_err, _, _ = hist_mean_rms(run_object)
+    return mean, mean_err
+
+def method_rms(run_object, inv_hours):
+    _, _, rms, rms_err = hist_mean_rms(run_object)
+    return rms, rms_err
+
+def method_selection(selection_type):
+    def selection_count(run_object, inv_hours):
+        raw_count = entries_selection(run_object, selection_type)
+        this_count = raw_count*inv_hours
+        return this_count, this_count/sqrt(raw_count)
+    return selection_count
+
+def method_hotspot_mean(run_object, inv_hours):
+    """
+    Mean occupancy in a defined 2D hotspot, normalised to run length.
+    """
+    # Get the short name of the sensor to use as a dictionary key
+    # e.g., "VPClusterMonitors_BeamCrossing/VPClusterMapOnMod10Sens2" -> "Mod10Sens2"
+    sensor_key = run_object.name.replace("VPClusterMapOn", "")
+
+    # Look up the region of interest (ROI) coordinates from our dictionary
+    if sensor_key not in populated_regions:
+        print(f"Warning: Sensor {sensor_key} not found in populated_regions dictionary. Skipping.")
+        return 0, 0
+    roi = populated_regions[sensor_key]
+    # Check if the region is defined (i.e., not for a scattered sensor)
+    if not roi['x'] or not roi['y']:
+        return 0, 0
+    if sensor_key in roi_bins:
+        start_x_bin, end_x_bin, start_y_bin, end_y_bin, n_bins_in_roi = roi_bins[sensor_key]
+    else:
+        # Convert the axis values from our dictionary into the correct bin indices
+        x_edges = run_object.axis(0).edges()
+        y_edges = run_object.axis(1).edges()
+        start_x_bin = find_bin(x_edges, roi['x'][0])
+        end_x_bin   = find_bin(x_edges, roi['x'][1])
+        start_y_bin = find_bin(y_edges, roi['y'][0])
+        end_y_bin   = find_bin(y_edges, roi['y'][1])
+
+        # Calculate the total number of bins in our rectangular region
+        n_bins_in_roi = (end_x_bin - start_x_bin + 1) * (end_y_bin - start_y_bin + 1)
+        roi_bins[sensor_key] = (start_x_bin, end_x_bin, start_y_bin, end_y_bin, n_bins_in_roi)
+
+    return hotspot_stats(hist_to_array(run_object), start_x_bin, end_x_bin,
+                         start_y_bin, end_y_bin, n_bins_in_roi, inv_hours)
+
+def method_bin(bin_number):
+    def bin_count(run_object, inv_hours):
+        raw_count = float(hist_to_array(run_object)[bin_number])
+        this_count = raw_count*inv_hours
+        return this_count, this_count/sqrt(raw_count)
+    return bin_count
+
+def method_bin_ratio(bin_number, ref_bin):
+    def bin_ratio(run_object, inv_hours):
+        contents = hist_to_array(run_object)
+        raw_count = float(contents[bin_number])
+        ref_count = float(contents[ref_bin])
+        return raw_count/ref_count, sqrt((1/raw_count+1/ref_count)*raw_count/ref_count)
+    return bin_ratio
+
+method_dispatch = {"raw": method_raw, "mean": method_mean, "RMS": method_rms,
+                   "hotspot_mean": method_hotspot_mean}
+for selection in ["quadrant1", "quadrant2", "quadrant3", "quadrant4", "negative", "positive"]:
+    method_dispatch[selection] = method_selection(selection)
+
+def resolve_method(method):
+    """
+    Turn a method string from the options into its callable. The bin
+    methods can be just "binx" (the bin content normalised to run
+    length) or "binxbiny" (the ratio of bin contents x/y); their bin
+    indices are parsed here, once, instead of per run.
+    """
+    if method in method_dispatch:
+        return method_dispatch[method]
+    if "bin" in method:
+        binslist = method.split("bin")
+        if len(binslist) > 2:
+            return method_bin_ratio(int(binslist[1]), int(binslist[2]))
+        return method_bin(int(binslist[1]))
+    print("resolve_method(): method",method,"unknown")
+    sys.exit(0)
+
 """
 End helper functions and begin main body of script
 We begin by deriving a bunch of locations and other "constants"
@@ -64,16 +244,77 @@ from various filesystem paths and command line inputs. This
 could be made more configurable in the future.
 """
 
-ROOT.gROOT.SetBatch(True)
-
 rundb_loc   = 'http://rundb-internal.lbdaq.cern.ch/api/run/'
 rundb_info  = 'rundb_files'
-rundb_time_format = '%Y-%m-%dT%H:%M:%S%z'
+os.makedirs(rundb_info, exist_ok=True) # wget used to create this implicitly
 file_suffix = '.root'
 min_run_length = 300. # minimum length of runs to be analyzed, in seconds
 require_offline = False # Look at data taken with destination local if needed
 publish_to_dqdb = True # Should we publish the information to the DQDB for trend plotting in MONET?
 
+"""
+The runDB information never changes once a run is over, but this script
+gets rerun over overlapping ranges all the time. Keep a persistent
+cache of the parsed dictionaries (together with the derived run length,
+since strptime is slow) so repeat visits skip the file I/O and parsing
+entirely. The cache lives next to the raw downloads and is written
+back at exit.
+"""
+rundb_cache_file = rundb_info+'/_parsed_cache.pkl'
+try:
+    rundb_cache = pickle.load(open(rundb_cache_file,'rb'))
+except Exception:
+    rundb_cache = {}
+
+def save_rundb_cache():
+    if os.path.isdir(rundb_info):
+        pickle.dump(rundb_cache, open(rundb_cache_file,'wb'))
+atexit.register(save_rundb_cache)
+
+def parse_iso(timestamp):
+    """
+    Parse the fixed runDB timestamp layout YYYY-MM-DDTHH:MM:SS+HHMM
+    into seconds since the epoch. strptime walks a locale table under
+    a lock and is surprisingly slow for such a rigid format; slicing
+    the fields out directly and using timegm is far cheaper and also
+    avoids the local-timezone conversion mktime would apply.
+    """
+    seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                               int(timestamp[8:10]), int(timestamp[11:13]),
+                               int(timestamp[14:16]), int(timestamp[17:19]),
+                               0, 0, 0))
+    if len(timestamp) > 19 and timestamp[19] in '+-':
+        utc_offset = int(timestamp[20:22])*3600 + int(timestamp[-2:])*60
+        seconds += -utc_offset if timestamp[19] == '+' else utc_offset
+    return seconds
+
+def get_run_info(run):
+    """
+    Return the {state, destination, starttime, endtime, run_length}
+    summary for a run, parsing the downloaded runDB file only on a
+    cache miss. Returns None if there is no valid runDB info, and
+    run_length is None when the start or end times cannot be parsed.
+    """
+    if run in rundb_cache:
+        return rundb_cache[run]
+    run_info_file = rundb_info+'/'+str(run)
+    if not os.path.exists(run_info_file):
+        return None
+    try:
+        run_info_dict = json.loads(open(run_info_file).read())
+        summary = {'state': run_info_dict['state'],
+                   'destination': run_info_dict.get('destination'),
+                   'starttime': run_info_dict.get('starttime'),
+                   'endtime': run_info_dict.get('endtime')}
+    except:
+        return None
+    try:
+        summary['run_length'] = parse_iso(summary['endtime'])-parse_iso(summary['starttime'])
+    except:
+        summary['run_length'] = None
+    rundb_cache[run] = summary
+    return summary
+
 if len(sys.argv) < 4:
     print("Lower and upper run number ranges must be specified, as well as the options")
     sys.exit(0)
@@ -99,6 +340,24 @@ except Exception as e:
     print(f"Error loading options module: {e}")
     sys.exit(1)
 
+"""
+The ROI coordinates and the histogram binning are identical for every
+run, so the bin indices derived from them in the hotspot_mean method
+are computed once per sensor on first sight and reused afterwards.
+"""
+roi_bins = {}
+
+"""
+Rerunning over an overlapping run range used to re-open every saveset
+and recompute every metric from scratch. The per-run results are tiny,
+so keep them as cache/{name}/{run}.json and replay them on later
+invocations; an entry is invalidated when the saveset has been
+rewritten since it was made. Replayed runs are not re-published to the
+DQDB since those points are already there.
+"""
+result_cache_dir = 'cache/'+options["name"]
+Path(result_cache_dir).mkdir(parents=True, exist_ok=True)
+
 
 """
 Now set the info for publishing to DQDB
@@ -126,27 +385,82 @@ if "provider" in options:
 saveset_dir = '/hist/Savesets/ByRun/'+provider+'/'
 file_prefix = provider+'-run'
 
+# Bind the per-location settings once; they never change between runs
+# so there is no reason to chase the dict lookups in the hot loop
+methods    = tuple(options["method"])
+locations  = tuple(options["locations"])
+method_fns = tuple(resolve_method(method) for method in methods)
+
+def extract_run_metrics(run, run_file, run_hours):
+    """
+    Compute the per-location counts and errors for one saveset file,
+    normalised to the run length in hours where relevant. Returns the
+    (counts, errors) lists, or None if any requested location is
+    missing from the file.
+    """
+    # First check that all requested locations are actually present in the file
+    for location in locations:
+        if location not in run_file:
+            print("Run "+str(run)+" does not contain "+location+" information")
+            return None
+
+    # For now support two kinds of information: absolute values and ratios
+    inv_hours = 1.0/run_hours
+    temp_counts = []
+    temp_errors = []
+    for location, method_fn in zip(locations, method_fns):
+        this_count, this_count_err = method_fn(run_file[location], inv_hours)
+        # Append count and error for local histogram plotting
+        temp_counts.append(this_count)
+        temp_errors.append(this_count_err)
+    return temp_counts, temp_errors
+
 """
 Now we get into the main body of the script, which is actually
 going to calculate the relevant quantities and populate the
 histograms (as well as the DQDB if that is requested)
 """
 
+"""
+Prefetch everything we will need from the network before the ROOT
+processing loop. First grab the runDB info for every run we have not
+seen before, then (now that the start times are known) fire the
+saveset creation requests for any run whose saveset is missing.
+"""
+
+fetch_urls([(rundb_loc+str(run), rundb_info+'/'+str(run))
+            for run in range(run_lower,run_upper+1)
+            if run not in rundb_cache and not os.path.exists(rundb_info+'/'+str(run))])
+
+saveset_requests = []
+for run in range(run_lower,run_upper+1):
+    # Consult the cached state first so historically CREATED runs cost
+    # nothing here, not even a stat of the saveset path
+    run_info_dict = get_run_info(run)
+    if run_info_dict is None or run_info_dict['state'] == 'CREATED' or \
+       run_info_dict['starttime'] is None:
+        continue
+    run_filename = saveset_dir+run_dir_from_run_no(run)+file_prefix+str(run)+file_suffix
+    if os.path.exists(run_filename):
+        continue
+    saveset_requests.append(
+        ('http://monitoringhub.lbdaq.cern.ch/v1/createrunsaveset/LHCb/'+\
+         str(run)+'?date='+run_info_dict['starttime'][0:10]+'&path=/hist', None))
+fetch_urls(saveset_requests)
+
 runs_info = {"numbers": [], "length": []}
+
+"""
+First select the runs to be processed, replaying cached results where
+possible. The remaining savesets are then opened and read by a thread
+pool (uproot releases the GIL while decompressing, so the reads
+genuinely overlap) and the results are consumed serially in run order
+afterwards, keeping the published points and the local plot ordered.
+"""
+
+runs_to_process = []
 for run in range(run_lower,run_upper+1):
     # The upper and lower run numbers are inclusive
-    run_filename = saveset_dir+run_dir_from_run_no(run)+file_prefix+str(run)+file_suffix
-    # Check if we downloaded the runDB info for this run already
-    run_info_file = rundb_info+'/'+str(run)
-    if not os.path.exists(run_info_file):
-        process = subprocess.Popen(
-            'wget '+rundb_loc+str(run)+' -P '+rundb_info,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            text = True,
-            shell = True
-        )
-        std_out, std_err = process.communicate()
 
     """
     Does this run have the right destination?
@@ -154,154 +468,107 @@ for run in range(run_lower,run_upper+1):
     "we are in global with all relevant detectors" but this whole
     script is agricultural so why make it fancier...
     """
-    run_info_dict = json.loads(open(run_info_file).read())
-    try:
-        if run_info_dict['state'] == 'CREATED' :
-            continue
-    except:
+    run_info_dict = get_run_info(run)
+    if run_info_dict is None:
         print('Run',run,'does not have a valid run info dictionary, continuing')
         continue
+    if run_info_dict['state'] == 'CREATED' :
+        # Short-circuit before touching the filesystem at all; the
+        # cached state makes this free on every later invocation too
+        continue
     if require_offline and run_info_dict['destination'] != 'OFFLINE':
         continue
+    run_filename = saveset_dir+run_dir_from_run_no(run)+file_prefix+str(run)+file_suffix
     if not os.path.exists(run_filename) :
-        print("Saveset for run "+str(run)+" with destination OFFLINE does not exist, trying to create it")
-        process = subprocess.Popen(
-            'wget http://monitoringhub.lbdaq.cern.ch/v1/createrunsaveset/LHCb/'+\
-                   str(run)+'?date='+run_info_dict['starttime'][0:10]+'\&path=/hist',
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            text = True,
-            shell = True
-        )
-        std_out,std_err = process.communicate()
-        if not os.path.exists(run_filename) :
-            print("Saveset for run "+str(run)+" with destination OFFLINE still does not exist, ignoring it")
-            continue
+        # The prefetch already asked the monitoring hub to create it
+        print("Saveset for run "+str(run)+" with destination OFFLINE does not exist, ignoring it")
+        continue
 
     # Get the run length, used to normalise yields
-    run_start = time.mktime(time.strptime(run_info_dict['starttime'],rundb_time_format))
-    run_end   = time.mktime(time.strptime(run_info_dict['endtime'],rundb_time_format))
-    run_length = run_end-run_start
+    run_length = run_info_dict['run_length']
+    if run_length is None:
+        print('Run',run,'does not have valid start and end times, continuing')
+        continue
 
     # Ignore runs below 5 minutes in length
     if run_length < min_run_length :
         print("Run "+str(run)+" was requested but is shorter than "+str(min_run_length)+" seconds, skipping")
         continue
 
-    # Now extract the actual information
-    run_file = TFile.Open(run_filename)
-    # Ignore runs with file not properly closed
-    if run_file.TestBit(TFile.kRecovered):
-        print("Run "+str(run)+" file needed to recovered and it can crash, skipping")
-        continue
+    # Check whether we already computed this run on a previous invocation
+    result_cache_file = result_cache_dir+'/'+str(run)+'.json'
+    cached_result = None
+    if os.path.exists(result_cache_file) and \
+       os.path.getmtime(result_cache_file) > os.path.getmtime(run_filename):
+        try:
+            parsed = json.loads(open(result_cache_file).read())
+            cached_result = (parsed["counts"], parsed["errors"],
+                             parsed.get("published", False))
+        except:
+            cached_result = None
+
+    runs_to_process.append((run, run_filename, run_length, result_cache_file, cached_result))
+
+def open_and_extract(run, run_filename, run_hours):
+    """
+    Open one saveset and extract its metrics, the unit of work handed
+    to the read pool. Returns (opened, metrics) so the serial consumer
+    can tell a failed open apart from a missing location.
+    """
+    try:
+        with uproot.open(run_filename) as run_file:
+            return True, extract_run_metrics(run, run_file, run_hours)
+    except Exception as e:
+        print("Run "+str(run)+" saveset could not be opened ("+str(e)+"), skipping")
+        return False, None
+
+with ThreadPoolExecutor(max_workers=8) as executor:
+    read_futures = {run: executor.submit(open_and_extract, run, run_filename, run_length/3600.)
+                    for run, run_filename, run_length, result_cache_file, cached_result
+                    in runs_to_process if cached_result is None}
+
+def write_result_cache(result_cache_file, run, counts, errors, published):
+    """
+    Persist the extracted metrics for one run, recording whether they
+    have made it into the DQDB yet so that a replay after a failed or
+    interrupted publish still publishes the point.
+    """
+    try:
+        json.dump({"counts": counts, "errors": errors, "published": published},
+                  open(result_cache_file,'w'))
+    except Exception as e:
+        print("Could not write result cache for run",run,":",e)
+
+for run, run_filename, run_length, result_cache_file, cached_result in runs_to_process:
+    from_cache = cached_result is not None
+    if from_cache:
+        temp_counts, temp_errors, already_published = cached_result
+    else:
+        already_published = False
+        opened, run_metrics = read_futures[run].result()
+        if not opened:
+            continue
 
     runs_info["numbers"].append(run)
     runs_info["length"].append(run_length/3600.) # convert seconds to hours
 
-    # For now support two kinds of information: absolute values and ratios
-    temp_counts = []
-    temp_errors = []
-    # First check that all requested locations are actually present in the file
-    location_not_found = False
-    for i,location in enumerate(options["locations"]):
-        run_object = run_file.Get(location)
-        if not run_object:
-            print("Run "+str(run)+" does not contain "+location+" information")
-            location_not_found = True
-            break
-    if location_not_found:
-        continue
-
-    for i,location in enumerate(options["locations"]):
-        run_object = run_file.Get(location)
-        # Without background subtraction or (to be implemented) with
-        if options["method"][i] == "raw" :
-            raw_count = run_object.GetEntries()
-            this_count = raw_count/runs_info["length"][-1]
-            this_count_err = sqrt(raw_count)/runs_info["length"][-1]
-        elif options["method"][i] == "mean" :
-            this_count = run_object.GetMean(1)
-            this_count_err = run_object.GetMeanError(1)
-        elif options["method"][i] == "RMS" :
-            this_count = run_object.GetRMS(1)
-            this_count_err = run_object.GetRMSError(1)
-        elif options["method"][i] in ["quadrant1", "quadrant2", "quadrant3", "quadrant4", "negative", "positive"]:
-            raw_count = entries_selection(run_object, options["method"][i])
-            this_count = raw_count/runs_info["length"][-1]
-            this_count_err = temp_counts[-1]/sqrt(raw_count)
-        # ===================================================================
-        # NEW METHOD FOR CALCULATING MEAN OCCUPANCY IN A DEFINED 2D HOTSPOT
-        # ===================================================================
-        elif options["method"][i] == "hotspot_mean":
-            # Get the short name of the sensor to use as a dictionary key
-            # e.g., "VPClusterMonitors_BeamCrossing/VPClusterMapOnMod10Sens2" -> "Mod10Sens2"
-            sensor_key = run_object.GetName().replace("VPClusterMapOn", "")
-
-            # Look up the region of interest (ROI) coordinates from our dictionary
-            if sensor_key not in populated_regions:
-                print(f"Warning: Sensor {sensor_key} not found in populated_regions dictionary. Skipping.")
-                this_count = 0
-                this_count_err = 0
-            else:
-                roi = populated_regions[sensor_key]
-                # Check if the region is defined (i.e., not for a scattered sensor)
-                if not roi['x'] or not roi['y']:
-                    this_count = 0
-                    this_count_err = 0
-                else:
-                    # Convert the axis values from our dictionary into the correct bin indices
-                    start_x_bin = run_object.GetXaxis().FindBin(roi['x'][0])
-                    end_x_bin   = run_object.GetXaxis().FindBin(roi['x'][1])
-                    start_y_bin = run_object.GetYaxis().FindBin(roi['y'][0])
-                    end_y_bin   = run_object.GetYaxis().FindBin(roi['y'][1])
-
-                    # Calculate the total number of bins in our rectangular region
-                    n_bins_in_roi = (end_x_bin - start_x_bin + 1) * (end_y_bin - start_y_bin + 1)
-
-                    # Get the sum of all entries within the hotspot bins
-                    integral = run_object.Integral(start_x_bin, end_x_bin, start_y_bin, end_y_bin)
-
-                    if n_bins_in_roi > 0 and integral > 0:
-                        # The mean is the total count divided by the number of bins
-                        mean_occupancy = integral / n_bins_in_roi
-
-                        # The error is sqrt(total_count) / number_of_bins
-                        mean_occupancy_err = sqrt(integral) / n_bins_in_roi
-
-                        # Normalize to the run length in hours
-                        this_count = mean_occupancy / runs_info["length"][-1]
-                        this_count_err = mean_occupancy_err / runs_info["length"][-1]
-                    else:
-                        this_count = 0
-                        this_count_err = 0
-        elif "bin" in options["method"][i]:
-            """
-            This can be just "binx" (which will be the bin content normalised to run length)
-            or it can be binxbiny (so ratio of bin contents x/y)
-            """
-            binslist = options["method"][i].split("bin")
-            bin = int(binslist[1])
-            raw_count = run_object.GetBinContent(bin)
-            if len(binslist)>2:
-                ref_count = run_object.GetBinContent(int(binslist[2]))
-                this_count = raw_count/ref_count
-                this_count_err = sqrt((1/raw_count+1/ref_count)*raw_count/ref_count)
-            else:
-                this_count = raw_count/runs_info["length"][-1]
-                this_count_err = temp_counts[-1]/sqrt(raw_count)
-        # Append count and error for local histogram plotting
-        temp_counts.append(this_count)
-        temp_errors.append(this_count_err)
+    if not from_cache:
+        if run_metrics is None:
+            continue
+        temp_counts, temp_errors = run_metrics
+        write_result_cache(result_cache_file, run, temp_counts, temp_errors, False)
 
     if options["type"] == "absolute" :
         options["counts"].append(temp_counts[0])
         options["errors"].append(temp_errors[0])
-        # Now write to DQDB for publication in MONET
-        if publish_to_dqdb :
+        # Now write to DQDB for publication in MONET, unless the cache
+        # already recorded a successful publish for this run
+        if publish_to_dqdb and not already_published :
             save_in_dqdb(git_key, run, '',
                          {dqdb_name : temp_counts[0],
                           dqdb_err_name : temp_errors[0] },
                          options["name"], algorithm )
+            write_result_cache(result_cache_file, run, temp_counts, temp_errors, True)
     elif options["type"] == "ratio" :
         if temp_counts[0] == 0 or temp_counts[1] == 0:
             # Unphysical so do not publish in DQDB
@@ -313,12 +580,14 @@ for run in range(run_lower,run_upper+1):
         this_err = this_ratio*sqrt(pow(temp_errors[0]/temp_counts[0],2) + \
                                    pow(temp_errors[1]/temp_counts[1],2))
         options["errors"].append(this_err)
-        # Now write to DQDB for publication in MONET
-        if publish_to_dqdb :
+        # Now write to DQDB for publication in MONET, unless the cache
+        # already recorded a successful publish for this run
+        if publish_to_dqdb and not already_published :
             save_in_dqdb(git_key, run, '',
                          {dqdb_name : this_ratio,
                           dqdb_err_name : this_err },
                          options["name"], algorithm )
+            write_result_cache(result_cache_file, run, temp_counts, temp_errors, True)
 
 
 """
@@ -328,55 +597,50 @@ efficient way to make a bunch of plots in a format ready to be
 dropped into a presentation compared with screenshotting MONET.
 """
 
-output_plot = TH1F(options["name"].lower(),options["name"],
-                   len(runs_info["numbers"]),
-                   0,len(runs_info["numbers"]))
-output_plot.GetXaxis().SetTitle("Run")
-output_plot.GetXaxis().SetLabelSize(0.03)
-output_plot.GetYaxis().SetTitleSize(0.04)
-output_plot.GetYaxis().SetTitle(options["y_axis_title"])
-output_plot.GetYaxis().SetTitleOffset(1.35)
-for i,entry in enumerate(options["counts"]) :
-    output_plot.SetBinContent(i+1,entry)
-    output_plot.SetBinError(i+1,options["errors"][i])
-    output_plot.GetXaxis().SetBinLabel(i+1,str(runs_info["numbers"][i]))
-output_plot.LabelsOption("v","X")
+counts_arr = np.asarray(options["counts"], dtype='f8')
+errors_arr = np.asarray(options["errors"], dtype='f8')
+
+fig, ax = plt.subplots(figsize=(12,8))
+ax.errorbar(np.arange(len(counts_arr)), counts_arr, yerr=errors_arr,
+            fmt='o', ms=3, color='black')
+ax.set_title(options["name"])
+ax.set_xlabel("Run")
+ax.set_ylabel(options["y_axis_title"])
+ax.set_xticks(range(len(runs_info["numbers"])))
+ax.set_xticklabels([str(number) for number in runs_info["numbers"]],
+                   rotation='vertical', fontsize=8)
 
 y_range = options.get("y_range",None)
 if y_range is not None:
-    output_plot.SetMinimum(y_range[0])
-    output_plot.SetMaximum(y_range[1])
-else:
-    output_plot_minimum = output_plot.GetMinimum()
+    ax.set_ylim(y_range[0],y_range[1])
+elif len(counts_arr):
+    output_plot_minimum = counts_arr.min()
+    output_plot_absolute_maximum = counts_arr.max()
     """
     Now for a bit of tortured logic to remove upper outliers in some plots...
     """
-    output_plot_maximum = 0.
-    for thisbin in range(output_plot.GetNbinsX()):
-        output_plot_maximum += output_plot.GetBinContent(thisbin+1)
-    output_plot_maximum /= 1.0*output_plot.GetNbinsX()
-    if 5.*output_plot_maximum > output_plot.GetMaximum():
-        output_plot_maximum = output_plot.GetMaximum()
+    output_plot_maximum = counts_arr.mean()
+    if 5.*output_plot_maximum > output_plot_absolute_maximum:
+        output_plot_maximum = output_plot_absolute_maximum
     #
     if output_plot_minimum > 0. :
-        output_plot.GetYaxis().SetRangeUser(0,1.5*output_plot_maximum)
+        ax.set_ylim(0,1.5*output_plot_maximum)
     else :
         """
         The earlier outlier removal does not really work if you are oscillating
         around zero since you finish with a very small mean value
         """
-        output_plot_maximum = output_plot.GetMaximum()
+        output_plot_maximum = output_plot_absolute_maximum
         if output_plot_maximum > 0. :
-            output_plot.GetYaxis().SetRangeUser(1.5*output_plot_minimum,1.5*output_plot_maximum)
+            ax.set_ylim(1.5*output_plot_minimum,1.5*output_plot_maximum)
         else :
-            output_plot.GetYaxis().SetRangeUser(1.5*output_plot_minimum,0.5*output_plot_maximum)
+            ax.set_ylim(1.5*output_plot_minimum,0.5*output_plot_maximum)
 
-canvas = TCanvas("trend_canvas","trend_canvas",1200,800)
-canvas.cd()
-output_plot.Draw()
 plotname=f"{Path.cwd()}/figures/{run_lower}_{run_upper}/{report_type}/"+options["name"]+f"_{run_lower}_{run_upper}.png"
 plotdirectory=plotname.rpartition('/')[0]
 if Path(plotdirectory).exists() is False:
     Path(plotdirectory).mkdir(parents=True, exist_ok=True)
-canvas.SaveAs(plotname)
-canvas.SaveAs(plotname.replace('png','pdf'))
+fig.tight_layout()
+fig.savefig(plotname)
+fig.savefig(plotname.replace('png','pdf'))
+plt.close(fig)
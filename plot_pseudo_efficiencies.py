@@ -20,28 +20,38 @@ Notes:
 import sys
 import os
 import json
-import time
-import subprocess
+import calendar
+import pickle
+import atexit
 from math import floor
 from importlib import import_module as load_options
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# ROOT imports
-import ROOT
-from ROOT import TFile, TCanvas, TGraphErrors, TMultiGraph, TLegend
+import requests
 
-import numpy as np
+# Savesets are read with uproot (no PyROOT anywhere in this script)
+import uproot
 
-# Local helper used to push data to DQDB (must be on PYTHONPATH)
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # headless backend, we only save files
+import matplotlib.pyplot as plt
+
+# Local helper used to push data to DQDB (must be on PYTHONPATH).
+# Newer versions of the helper provide a batched entry point that POSTs
+# all metrics for a run in one request; fall back to a single combined
+# save_in_dqdb call when running against an older helper.
 from save_in_dqdb import save_in_dqdb
+try:
+    from save_in_dqdb import save_in_dqdb_batch
+except ImportError:
+    save_in_dqdb_batch = None
 
 # ---------- Configuration ----------
-ROOT.gROOT.SetBatch(True)
-ROOT.gStyle.SetOptStat(0)
-
 rundb_loc   = 'http://rundb-internal.lbdaq.cern.ch/api/run/'
 rundb_info  = 'rundb_files'
-rundb_time_format = '%Y-%m-%dT%H:%M:%S%z'
+os.makedirs(rundb_info, exist_ok=True) # wget used to create this implicitly
 file_suffix = '.root'
 min_run_length = 300.0    # seconds
 require_offline = False
@@ -52,6 +62,11 @@ VELO_SENSOR_NAMES = ['VP00', 'VP01', 'VP02', 'VP10', 'VP11', 'VP12',
                      'VP20', 'VP21', 'VP22', 'VP30', 'VP31', 'VP32']
 TOTAL_MODULES = 52 # Modules 0-51
 
+# One distinguishable colour per module, built once at import time
+# rather than rebuilt for every sensor in the verification loop
+MODULE_COLORS = tuple(plt.get_cmap('turbo', TOTAL_MODULES)(i)
+                      for i in range(TOTAL_MODULES))
+
 # ------------------------------------
 
 def run_dir_from_run_no(run_no):
@@ -59,6 +74,87 @@ def run_dir_from_run_no(run_no):
     sd_2 = floor(run_no/1000)*1000
     return f"{sd_1}/{sd_2}/"
 
+def fetch_url(session, url, destination):
+    """Fetch one URL; destination None means we only care about the side effect."""
+    response = session.get(url)
+    response.raise_for_status()
+    if destination is not None:
+        open(destination, 'wb').write(response.content)
+
+def fetch_urls(downloads):
+    """
+    Download a batch of (url, destination) pairs concurrently over one
+    keep-alive session. The work is I/O bound so a thread pool overlaps
+    the network waits; failures are reported but not fatal.
+    """
+    if not downloads:
+        return
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=32) as executor:
+        futures = {executor.submit(fetch_url, session, url, destination): url
+                   for url, destination in downloads}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Download of {futures[future]} failed: {e}")
+
+# Persistent cache of parsed runDB info, shared with plot_occupancies.py.
+# The raw JSON never changes once downloaded, so cache the parsed summary
+# (including the derived run length, strptime being slow) across reruns.
+rundb_cache_file = f"{rundb_info}/_parsed_cache.pkl"
+try:
+    rundb_cache = pickle.load(open(rundb_cache_file, 'rb'))
+except Exception:
+    rundb_cache = {}
+
+def save_rundb_cache():
+    if os.path.isdir(rundb_info):
+        pickle.dump(rundb_cache, open(rundb_cache_file, 'wb'))
+atexit.register(save_rundb_cache)
+
+def parse_iso(timestamp):
+    """
+    Parse the fixed runDB timestamp layout YYYY-MM-DDTHH:MM:SS+HHMM into
+    epoch seconds by direct slicing. Much cheaper than strptime (which
+    locks and walks a locale table) and timegm sidesteps the local
+    timezone conversion mktime would apply.
+    """
+    seconds = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                               int(timestamp[8:10]), int(timestamp[11:13]),
+                               int(timestamp[14:16]), int(timestamp[17:19]),
+                               0, 0, 0))
+    if len(timestamp) > 19 and timestamp[19] in '+-':
+        utc_offset = int(timestamp[20:22])*3600 + int(timestamp[-2:])*60
+        seconds += -utc_offset if timestamp[19] == '+' else utc_offset
+    return seconds
+
+def get_run_info(run):
+    """
+    Return the {state, destination, starttime, endtime, run_length}
+    summary for a run, parsing the downloaded runDB file only on a
+    cache miss. Returns None when no valid runDB info exists;
+    run_length is None when the start/end times cannot be parsed.
+    """
+    if run in rundb_cache:
+        return rundb_cache[run]
+    run_info_file = f"{rundb_info}/{run}"
+    if not os.path.exists(run_info_file):
+        return None
+    try:
+        run_info_dict = json.load(open(run_info_file))
+        summary = {'state': run_info_dict['state'],
+                   'destination': run_info_dict.get('destination'),
+                   'starttime': run_info_dict.get('starttime'),
+                   'endtime': run_info_dict.get('endtime')}
+    except Exception:
+        return None
+    try:
+        summary['run_length'] = parse_iso(summary['endtime']) - parse_iso(summary['starttime'])
+    except Exception:
+        summary['run_length'] = None
+    rundb_cache[run] = summary
+    return summary
+
 def usage_and_exit():
     print("Usage: python3 plot_trends_publish_multi.py <run_lower> <run_upper> <options_path>")
     print("Example: python3 plot_trends_publish_multi.py 310000 310999 tracking/publish_velo_all_sensors")
@@ -107,175 +203,198 @@ for k in required_keys:
         print(f"Options file missing required key: {k}")
         sys.exit(1)
 
-# Prepare storage for published data
-published_data_for_verification = {
-    sensor: {
-        module_idx: {"runs": [], "values": [], "errors": []}
-        for module_idx in range(TOTAL_MODULES)
-    } for sensor in VELO_SENSOR_NAMES
-}
+# Prepare storage for published data: one (sensor, module, run) value
+# and error array instead of a dict-of-dict-of-lists. NaN marks slots
+# that never got a point; ~500 KB for a 1000-run range, and the plot
+# loop below reads contiguous per-module slices straight out of it.
+SENSOR_INDEX = {sensor: idx for idx, sensor in enumerate(VELO_SENSOR_NAMES)}
+n_runs_requested = run_upper - run_lower + 1
+published_values = np.full((len(VELO_SENSOR_NAMES), TOTAL_MODULES, n_runs_requested),
+                           np.nan, dtype='f4')
+published_errors = np.full_like(published_values, np.nan)
 
 runs_info = {"numbers": [], "length": []}
 
-# Main loop over runs
+# Prefetch all missing runDB info concurrently, then (with start times
+# in hand) fire the saveset creation requests for missing savesets, so
+# the ROOT processing loop below never waits on the network.
+fetch_urls([(f"{rundb_loc}{run}", f"{rundb_info}/{run}")
+            for run in range(run_lower, run_upper + 1)
+            if run not in rundb_cache and not os.path.exists(f"{rundb_info}/{run}")])
+
+saveset_requests = []
 for run in range(run_lower, run_upper + 1):
+    # Consult the cached state first so historically CREATED runs cost
+    # nothing here, not even a stat of the saveset path
+    run_info_dict = get_run_info(run)
+    if run_info_dict is None or run_info_dict['state'] == 'CREATED' or \
+       run_info_dict['starttime'] is None:
+        continue
     run_filename = saveset_dir + run_dir_from_run_no(run) + file_prefix + str(run) + file_suffix
-    run_info_file = f"{rundb_info}/{run}"
-
-    if not os.path.exists(run_info_file):
-        proc = subprocess.Popen(f"wget {rundb_loc}{run} -P {rundb_info}",
-                                shell=True, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, text=True)
-        proc.communicate()
-
-    try:
-        run_info_dict = json.load(open(run_info_file))
-    except Exception as e:
-        print(f"Run {run}: cannot read run info ({e}), skipping")
+    if os.path.exists(run_filename):
+        continue
+    saveset_requests.append(
+        ('http://monitoringhub.lbdaq.cern.ch/v1/createrunsaveset/LHCb/' + str(run) +
+         '?date=' + run_info_dict['starttime'][0:10] + '&path=/hist', None))
+fetch_urls(saveset_requests)
+
+# Select the runs to process, then read their savesets with a thread
+# pool (uproot releases the GIL while decompressing, so the reads
+# genuinely overlap). The results are consumed serially in run order
+# below so the published points stay ordered.
+runs_to_process = []
+for run in range(run_lower, run_upper + 1):
+    run_info_dict = get_run_info(run)
+    if run_info_dict is None:
+        print(f"Run {run}: cannot read run info, skipping")
         continue
 
-    if run_info_dict.get('state') == 'CREATED':
+    if run_info_dict['state'] == 'CREATED':
+        # Short-circuit before touching the filesystem at all; the
+        # cached state makes this free on every later invocation too
         continue
-    if require_offline and run_info_dict.get('destination') != 'OFFLINE':
+    if require_offline and run_info_dict['destination'] != 'OFFLINE':
         continue
 
-    try:
-        run_start = time.mktime(time.strptime(run_info_dict['starttime'], rundb_time_format))
-        run_end = time.mktime(time.strptime(run_info_dict['endtime'], rundb_time_format))
-        run_length = run_end - run_start
-    except Exception as e:
-        print(f"Run {run}: run time parse error ({e}), skipping")
+    run_filename = saveset_dir + run_dir_from_run_no(run) + file_prefix + str(run) + file_suffix
+
+    run_length = run_info_dict['run_length']
+    if run_length is None:
+        print(f"Run {run}: run time parse error, skipping")
         continue
 
     if run_length < min_run_length:
         continue
 
     if not os.path.exists(run_filename):
-        print(f"Run {run}: saveset missing, attempting to create via monitoringhub")
-        proc = subprocess.Popen(
-            'wget http://monitoringhub.lbdaq.cern.ch/v1/createrunsaveset/LHCb/' + str(run) +
-            '?date=' + run_info_dict['starttime'][0:10] + '\&path=/hist',
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        proc.communicate()
-        if not os.path.exists(run_filename):
-            print(f"Run {run}: saveset still missing after request, skipping")
-            continue
-
-    run_file = TFile.Open(run_filename)
-    if not run_file or run_file.IsZombie():
-        print(f"Run {run}: cannot open saveset file, skipping")
+        # The prefetch already asked the monitoring hub to create it
+        print(f"Run {run}: saveset still missing after creation request, skipping")
         continue
-    if run_file.TestBit(TFile.kRecovered):
-        print(f"Run {run}: file needed recovery, skipping")
+
+    runs_to_process.append((run, run_filename, run_length))
+
+def read_run_efficiencies(run, run_filename):
+    """
+    Open one saveset and read the per-sensor efficiency arrays, the
+    unit of work handed to the read pool. Returns a {sensor: (values,
+    errors)} dict, or None when the file cannot be opened.
+    """
+    try:
+        with uproot.open(run_filename) as run_file:
+            sensor_arrays = {}
+            for sensor_name in VELO_SENSOR_NAMES:
+                # FIXED: only replace the histogram name token, not every "VP"
+                location = options["locations"][0].replace("hiteff_asicVP", f"hiteff_asic{sensor_name}")
+                if location not in run_file:
+                    print(f"Run {run}: histogram '{location}' not found, skipping sensor {sensor_name}")
+                    continue
+                hist = run_file[location]
+                # One array read per histogram instead of a bin content/
+                # error lookup pair per module
+                sensor_arrays[sensor_name] = (hist.values(), hist.errors())
+            return sensor_arrays
+    except Exception as e:
+        print(f"Run {run}: cannot open saveset file ({e}), skipping")
+        return None
+
+with ThreadPoolExecutor(max_workers=8) as read_pool:
+    read_futures = {run: read_pool.submit(read_run_efficiencies, run, run_filename)
+                    for run, run_filename, run_length in runs_to_process}
+
+# Main loop over runs, in order
+for run, run_filename, run_length in runs_to_process:
+    run_sensor_arrays = read_futures[run].result()
+    if run_sensor_arrays is None:
         continue
 
     runs_info["numbers"].append(run)
     runs_info["length"].append(run_length / 3600.0)
 
-    # --- Loop through each sensor and its modules ---
-    for sensor_name in VELO_SENSOR_NAMES:
-        # FIXED: only replace the histogram name token, not every "VP"
-        location = options["locations"][0].replace("hiteff_asicVP", f"hiteff_asic{sensor_name}")
-        hist = run_file.Get(location)
-        if not hist:
-            print(f"Run {run}: histogram '{location}' not found, skipping sensor {sensor_name}")
-            continue
+    # All (metric, value) pairs for this run are collected here and
+    # published in one request after the sensor/module loops, instead
+    # of one HTTPS round-trip per module (12 x 52 per run).
+    batch_payload = {}
 
+    # --- Loop through each sensor and its modules ---
+    for sensor_name, (bin_values, bin_errors) in run_sensor_arrays.items():
         for module_idx in range(TOTAL_MODULES):
             bin_number = module_idx + 1
-            if bin_number < 1 or bin_number > hist.GetNbinsX():
+            if bin_number < 1 or bin_number > len(bin_values):
                 print(f"Run {run}: Sensor {sensor_name}, module {module_idx} -> invalid bin {bin_number}, skipping")
                 continue
 
-            eff = hist.GetBinContent(bin_number)
-            eff_err = hist.GetBinError(bin_number)
+            eff = float(bin_values[module_idx])
+            eff_err = float(bin_errors[module_idx])
 
             metric_name = f"velo_asic_{sensor_name}_mod{module_idx}_eff"
             metric_err_name = metric_name + "_err"
-            unique_algorithm = f"rta_piquet_trends|tracking|publish_velo_{sensor_name}_mod{module_idx}"
 
-            data_to_publish = {
-                metric_name: eff,
-                metric_err_name: eff_err,
-            }
+            batch_payload[metric_name] = eff
+            batch_payload[metric_err_name] = eff_err
 
-            published_data_for_verification[sensor_name][module_idx]["runs"].append(run)
-            published_data_for_verification[sensor_name][module_idx]["values"].append(eff)
-            published_data_for_verification[sensor_name][module_idx]["errors"].append(eff_err)
+            published_values[SENSOR_INDEX[sensor_name], module_idx, run - run_lower] = eff
+            published_errors[SENSOR_INDEX[sensor_name], module_idx, run - run_lower] = eff_err
 
-            if publish_to_dqdb:
-                try:
-                    save_in_dqdb(git_key, run, '', data_to_publish, metric_name, unique_algorithm)
-                    print(f"Run {run}: published sensor {sensor_name}, module {module_idx}")
-                except Exception as e:
-                    print(f"Run {run}: save_in_dqdb FAILED for sensor {sensor_name}, module {module_idx}: {e}")
+    # --- Publish everything collected for this run in one go ---
+    if publish_to_dqdb and batch_payload:
+        batch_algorithm = "rta_piquet_trends|tracking|publish_velo_all_sensors"
+        try:
+            if save_in_dqdb_batch is not None:
+                save_in_dqdb_batch(git_key, run, '', batch_payload, dqdb_base_name, batch_algorithm)
+            else:
+                save_in_dqdb(git_key, run, '', batch_payload, dqdb_base_name, batch_algorithm)
+            print(f"Run {run}: published {len(batch_payload) // 2} sensor-module metrics in one batch")
+        except Exception as e:
+            print(f"Run {run}: batched save_in_dqdb FAILED: {e}")
 
 # After loop: create verification overlay PNGs
 out_dir = Path(f"{Path.cwd()}/figures/{run_lower}_{run_upper}/publishing_all_sensors_verify/")
 out_dir.mkdir(parents=True, exist_ok=True)
 
-for sensor_name in VELO_SENSOR_NAMES:
-    any_points_for_sensor = any(published_data_for_verification[sensor_name][m]["runs"]
-                                for m in range(TOTAL_MODULES))
+# One figure is reused for every sensor (cleared in between) rather
+# than allocating and tearing down a fresh 1400x700 figure per sensor.
+fig, ax = plt.subplots(figsize=(14, 7))
+
+run_axis = np.arange(run_lower, run_upper + 1, dtype='f')
+
+for sensor_idx, sensor_name in enumerate(VELO_SENSOR_NAMES):
+    sensor_values = published_values[sensor_idx]
+    sensor_errors = published_errors[sensor_idx]
+    any_points_for_sensor = not np.isnan(sensor_values).all()
     if any_points_for_sensor:
         png_path = out_dir / f"velo_asic_{sensor_name}_eff_{run_lower}_{run_upper}_all_modules_verify.png"
-        canvas = TCanvas(f"c_verify_{sensor_name}", f"Verification - {sensor_name} all modules", 1400, 700)
-        canvas.SetGrid()
-        mg = TMultiGraph()
-        legend = TLegend(0.75, 0.15, 0.95, 0.55)
-        legend.SetFillStyle(0)
-        legend.SetBorderSize(0)
-
-        colors = [ROOT.kBlue, ROOT.kRed, ROOT.kGreen+2, ROOT.kMagenta, ROOT.kCyan,
-                  ROOT.kOrange+7, ROOT.kViolet-5, ROOT.kSpring+9, ROOT.kAzure+10,
-                  ROOT.kBlack, ROOT.kGray, ROOT.kPink, ROOT.kSpring, ROOT.kTeal,
-                  ROOT.kViolet, ROOT.kOrange, ROOT.kCyan+2, ROOT.kRed-4, ROOT.kGreen-3,
-                  ROOT.kMagenta-2, ROOT.kBlue-1, ROOT.kYellow+2, ROOT.kSpring+10,
-                  ROOT.kAzure+9, ROOT.kPink+1, ROOT.kOrange-3, ROOT.kCyan-1, ROOT.kRed+1,
-                  ROOT.kGreen+1, ROOT.kMagenta+1, ROOT.kBlue+1, ROOT.kYellow-1, ROOT.kSpring-1,
-                  ROOT.kAzure-1, ROOT.kPink-1, ROOT.kOrange+1, ROOT.kCyan+1, ROOT.kRed+2,
-                  ROOT.kGreen+3, ROOT.kMagenta+4, ROOT.kBlue+5, ROOT.kYellow+6, ROOT.kSpring+7,
-                  ROOT.kAzure+8, ROOT.kPink+9, ROOT.kOrange+10, ROOT.kCyan+11, ROOT.kRed+12,
-                  ROOT.kGreen+13, ROOT.kMagenta+14, ROOT.kBlue+15, ROOT.kYellow+16]
-
-        for idx, module_idx in enumerate(range(TOTAL_MODULES)):
-            data = published_data_for_verification[sensor_name][module_idx]
-            if not data["runs"]:
+        ax.clear()
+        ax.grid(True)
+
+        for module_idx in range(TOTAL_MODULES):
+            # Contiguous per-module slices; run order is already sorted
+            # by construction and NaN marks the runs without a point
+            filled = ~np.isnan(sensor_values[module_idx])
+            if not filled.any():
                 continue
-            order = np.argsort(data["runs"])
-            x_vals = np.array(data["runs"], dtype='f')[order]
-            y_vals = np.array(data["values"], dtype='f')[order]
-            y_errs = np.array(data["errors"], dtype='f')[order]
-            n = len(x_vals)
-            x_errs = np.zeros(n, dtype='f')
-
-            graph = TGraphErrors(n, x_vals, y_vals, x_errs, y_errs)
-            graph.SetMarkerStyle(20)
-            graph.SetMarkerSize(0.9)
-            color = colors[idx % len(colors)]
-            graph.SetMarkerColor(color)
-            graph.SetLineColor(color)
-            mg.Add(graph, "P")
-            legend.AddEntry(graph, f"Mod {module_idx}", "p")
-
-        mg.SetTitle(f"Hit Efficiency ({sensor_name}) - All Modules")
-        mg.Draw("AP")
-        if mg.GetXaxis():
-            mg.GetXaxis().SetTitle("Run Number")
-            mg.GetXaxis().SetNoExponent(True)
-            mg.GetXaxis().SetNdivisions(505)
-        if mg.GetYaxis():
-            mg.GetYaxis().SetTitle("Hit Efficiency")
-
-        legend.Draw()
-        canvas.Update()
-        canvas.SaveAs(str(png_path))
+            x_vals = run_axis[filled]
+            y_vals = sensor_values[module_idx][filled]
+            y_errs = sensor_errors[module_idx][filled]
+
+            ax.errorbar(x_vals, y_vals, yerr=y_errs, fmt='o', ms=3,
+                        color=MODULE_COLORS[module_idx],
+                        label=f"Mod {module_idx}")
+
+        ax.set_title(f"Hit Efficiency ({sensor_name}) - All Modules")
+        ax.set_xlabel("Run Number")
+        ax.set_ylabel("Hit Efficiency")
+        ax.ticklabel_format(axis='x', style='plain', useOffset=False)
+        ax.legend(loc='center left', bbox_to_anchor=(1.01, 0.5),
+                  ncol=2, fontsize=6, frameon=False)
+        fig.tight_layout()
+        fig.savefig(png_path, dpi=100)
         print(f"Saved verification plot: {png_path}")
     else:
         print(f"No published points found for sensor {sensor_name}; no verification PNG created.")
 
-total_published_points = sum(len(published_data_for_verification[s][m]["runs"])
-                              for s in VELO_SENSOR_NAMES for m in range(TOTAL_MODULES))
+plt.close(fig)
+
+total_published_points = int((~np.isnan(published_values)).sum())
 print(f"Finished. Total unique sensor-module points published: {total_published_points}")
 
 sys.exit(0)
@@ -0,0 +1,49 @@
+"""
+Compiled reduction kernels for the trend scripts.
+
+The per-run reductions (hotspot means, quadrant and half-plane
+integrals) are tight numeric loops over histogram content arrays,
+which numba compiles to machine code once and then reuses for every
+run and sensor. When numba is not available the same functions run as
+plain Python, so the scripts work either way.
+"""
+
+from math import sqrt
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def wrap(func):
+            return func
+        return wrap
+
+@njit(cache=True, fastmath=True)
+def region_sum_1d(contents, start, end):
+    """Sum of a 1D content array over the inclusive ROOT bins [start, end]."""
+    total = 0.
+    for x in range(start, end+1):
+        total += contents[x]
+    return total
+
+@njit(cache=True, fastmath=True)
+def region_sum(contents, start_x, end_x, start_y, end_y):
+    """Sum of a 2D content array over inclusive ROOT bin ranges on both axes."""
+    total = 0.
+    for x in range(start_x, end_x+1):
+        for y in range(start_y, end_y+1):
+            total += contents[x, y]
+    return total
+
+@njit(cache=True, fastmath=True)
+def hotspot_stats(contents, start_x, end_x, start_y, end_y, n_bins, inv_hours):
+    """
+    Mean occupancy in the ROI and its error, normalised to the run
+    length in hours. Returns (0., 0.) when the ROI holds no entries.
+    """
+    integral = region_sum(contents, start_x, end_x, start_y, end_y)
+    if n_bins <= 0 or integral <= 0:
+        return 0., 0.
+    # The mean is the total count divided by the number of bins, with
+    # error sqrt(total_count)/number_of_bins
+    return integral/n_bins*inv_hours, sqrt(integral)/n_bins*inv_hours